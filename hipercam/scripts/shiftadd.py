@@ -1,11 +1,13 @@
-import copy
+import importlib.util
+import math
 import os
 import signal
 import sys
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-from astropy.stats import sigma_clip
+from astropy.io import fits
 from astropy.wcs import wcs
 from trm import cline
 from trm.cline import Cline
@@ -24,14 +26,32 @@ try:
 
     meanfunc = bn.nanmean
     medianfunc = bn.nanmedian
+    stdfunc = bn.nanstd
+    anynan = bn.anynan
 except ImportError:
     meanfunc = np.nanmean
     medianfunc = np.nanmedian
+    stdfunc = np.nanstd
+
+    def anynan(arr):
+        return np.isnan(arr).any()
+
 
 __all__ = [
     "shiftadd",
 ]
 
+# number of rows combined at a time
+TILE = 256
+
+# side of the blocks multi-threaded reprojections are split into
+BLOCK = 256
+
+# interpolation orders dfreproject does as reproject does, and its names
+# for them. Its bicubic is cubic convolution rather than a cubic spline
+# and differs by several percent on stars, so order 3 stays on the CPU.
+GPU_ORDERS = {0: "nearest", 1: "bilinear"}
+
 
 class CleanUp:
     """
@@ -62,7 +82,7 @@ def new_wcs(wbase, dx, dy):
     """
     Shifts an image by dx, dy
     """
-    wnew = copy.deepcopy(wbase)
+    wnew = wbase.deepcopy()
     wnew.wcs.crpix = [-dx, -dy]
     return wnew
 
@@ -116,11 +136,430 @@ def wcs_from_header(mccd):
     return w
 
 
+def _aper_windows(ccdaper, ccd):
+    """
+    Works out which window of a CCD each aperture lies in. Equivalent to
+    testing `wind.distance(aper.x, aper.y) > 0` for every aperture and
+    window, but done in one go with numpy.
+
+    Arguments::
+
+        ccdaper : CcdAper
+           the apertures
+
+        ccd : CCD
+           the CCD whose windows are searched
+
+    Returns: dictionary keyed by aperture label of the label of the first
+    window that contains the aperture, None if no window does.
+    """
+    apnams = list(ccdaper.keys())
+    wnams = list(ccd.keys())
+    x = np.array([aper.x for aper in ccdaper.values()])[:, None]
+    y = np.array([aper.y for aper in ccdaper.values()])[:, None]
+    xlo, xhi, ylo, yhi = np.array(
+        [(wind.xlo, wind.xhi, wind.ylo, wind.yhi) for wind in ccd.values()]
+    ).T
+    inside = (x > xlo) & (x < xhi) & (y > ylo) & (y < yhi)
+    iwins = inside.argmax(axis=1)
+    return {
+        apnam: wnams[iwin] if inside[n, iwin] else None
+        for n, (apnam, iwin) in enumerate(zip(apnams, iwins))
+    }
+
+
+def _clipped_mean(arr3d, sigma, maxiters):
+    """
+    Iteratively sigma-clipped mean along the last axis, ignoring
+    NaNs. This matches astropy's sigma_clip with cenfunc="mean" and
+    stdfunc="std" but avoids its (slow) masked arrays. Rejected values
+    are set to NaN in `arr3d`.
+    """
+    for _ in range(maxiters):
+        mean = meanfunc(arr3d, axis=-1)
+        std = stdfunc(arr3d, axis=-1)
+        clip = np.abs(arr3d - mean[..., None]) > sigma * std[..., None]
+        if not clip.any():
+            break
+        arr3d[clip] = np.nan
+    return meanfunc(arr3d, axis=-1)
+
+
+def _reproject_gpu(input_data, output_projection, shape_out, order):
+    """
+    Stand-in for reproject_interp that uses dfreproject, which runs on a
+    GPU if torch can find one. `order` is one of the keys of GPU_ORDERS.
+    Returns the reprojected array and None in place of the footprint,
+    which is not used. The WCSs differ only by a shift, so no Jacobian
+    is needed. Values are normalised by the footprint, which
+    reproject_interp does not do, hence differences within a pixel of
+    the edges of the input.
+
+    dfreproject scales coordinates by the width and height of the input
+    less one, so returns nothing but NaNs for inputs one pixel wide or
+    tall. These are handed to reproject_interp instead.
+    """
+    if min(input_data[0].shape) < 2:
+        return reproject_interp(
+            input_data,
+            output_projection,
+            shape_out,
+            order=order,
+            roundtrip_coords=False,
+        )
+
+    reprojected_data = _gpars["calculate_reprojection"](
+        input_data,
+        output_projection,
+        shape_out=shape_out,
+        order=GPU_ORDERS[order],
+        conserve_flux=True,
+        compute_jacobian=False,
+    )
+    # dfreproject squeezes its output, which loses axes of length 1
+    return reprojected_data.reshape(shape_out), None
+
+
+def _combine(arr3d, method, sigma, maxiters):
+    """
+    Combines a stack of images along the last axis, ignoring NaNs.
+
+    Arguments::
+
+        arr3d : 3D array
+           the images to combine, stacked along the last axis so that the
+           values of each pixel are contiguous in memory, which bottleneck
+           reduces fastest
+
+        method : str
+           'm' for median, 'c' for clipped mean
+
+        sigma : float
+           clipping threshold; <= 0 for a straight mean (method 'c' only)
+
+        maxiters : int
+           maximum number of clipping iterations (method 'c' only)
+
+    Returns: the combined 2D array
+    """
+    with warnings.catch_warnings():
+        # ignore warnings about all-nan slices
+        # (we set NaNs outside of the windows)
+        warnings.filterwarnings(
+            "ignore",
+            category=RuntimeWarning,
+            message="All-NaN slice encountered|Mean of empty slice|Degrees of freedom",
+        )
+        if method == "m":
+            return medianfunc(arr3d, axis=-1)
+        elif method == "c" and sigma > 0:
+            # clipped mean
+            return _clipped_mean(arr3d, sigma, maxiters)
+        else:
+            # simple mean
+            return meanfunc(arr3d, axis=-1)
+
+
+# Globals used by _add_frame and _combine_ccd, set once per process by
+# _init_stack to save passing them, and rebuilding the WCS, with every
+# frame. When running in parallel, each process looks after a fixed set of
+# CCDs, accumulating their frames in _gstore.
+_gpars = None
+_gstore = {}
+
+
+def _init_stack(
+    wcs_header,
+    wind_bounds,
+    nstack,
+    reprmethod,
+    backend,
+    nthreads,
+    repr_kwargs,
+    method,
+    sigma,
+    maxiters,
+):
+    """
+    Sets up the globals used by _add_frame and _combine_ccd.
+
+    Arguments::
+
+        wcs_header : str
+           header defining the WCS of the output (binned) full frame, from
+           which the WCS is rebuilt. WCS objects do not pickle reliably.
+
+        wind_bounds : dict
+           binned pixel limits (xstart, xend, ystart, yend) of every window,
+           keyed by CCD then window label.
+
+        nstack : int
+           the most frames there can be to stack
+
+        reprmethod : str
+           'interp', 'adaptive' or 'exact'
+
+        backend : str
+           'cpu' to use reproject, 'gpu' to use dfreproject ('interp' only)
+
+        nthreads : int
+           number of threads each reprojection may use (CPU only)
+
+        repr_kwargs : dict
+           keyword arguments passed on to the reprojection function
+
+        method : str
+           'm' for median, 'c' for clipped mean
+
+        sigma : float
+           clipping threshold (method 'c' only)
+
+        maxiters : int
+           maximum number of clipping iterations (method 'c' only)
+    """
+    global _gpars
+    _gstore.clear()
+    orig_wcs = wcs.WCS(fits.Header.fromstring(wcs_header))
+    if backend == "gpu":
+        # dfreproject loads torch, which is slow, so it is only imported
+        # when needed
+        from dfreproject import calculate_reprojection
+
+        reproject = _reproject_gpu
+    else:
+        calculate_reprojection = None
+        reproject = {
+            "interp": reproject_interp,
+            "adaptive": reproject_adaptive,
+            "exact": reproject_exact,
+        }[reprmethod]
+    _gpars = {
+        "reproject": reproject,
+        "calculate_reprojection": calculate_reprojection,
+        "kwargs": repr_kwargs,
+        # reproject's threading has a fixed cost (dask and a temporary
+        # store) that only pays off for boxes bigger than a block
+        "big_kwargs": (
+            {**repr_kwargs, "parallel": nthreads, "block_size": (BLOCK, BLOCK)}
+            if nthreads > 1 and backend == "cpu"
+            else repr_kwargs
+        ),
+        # Template WCSs for the input windows and the output boxes they
+        # are reprojected onto. Only the reference pixels change from
+        # window to window, so these are updated in place rather than
+        # copied every time.
+        "pixel_wcs": orig_wcs.deepcopy(),
+        "box_wcs": orig_wcs.deepcopy(),
+        "crpix": tuple(orig_wcs.wcs.crpix),
+        "wind_bounds": wind_bounds,
+        "nstack": nstack,
+        "method": method,
+        "sigma": sigma,
+        "maxiters": maxiters,
+        # Interpolation and exact reprojection return the input unchanged
+        # when there is no shift, but adaptive smooths it.
+        "copy_unshifted": reprmethod != "adaptive",
+        # A straight mean can be accumulated frame by frame, so there is
+        # no need to hold all of them in memory. Clipping and medians need
+        # the full stack.
+        "stream": method == "c" and sigma <= 0,
+    }
+
+
+def _add_frame(cnam, ccd, frame_offset_x, frame_offset_y):
+    """
+    Reprojects a CCD from one frame onto its (binned) windows, shifted
+    by the offset of the frame, and adds the result to those so far
+    accumulated for CCD `cnam`.
+
+    Arguments::
+
+        cnam : str
+           label of the CCD
+
+        ccd : CCD
+           the data
+
+        frame_offset_x, frame_offset_y : float
+           offset of the frame, unbinned pixels
+    """
+    crval1, crval2 = _gpars["crpix"]
+    pixel_wcs = _gpars["pixel_wcs"]
+    box_wcs = _gpars["box_wcs"]
+    stream = _gpars["stream"]
+    wind_bounds = _gpars["wind_bounds"][cnam]
+
+    if cnam not in _gstore:
+        # first frame of this CCD
+        store = {"nframes": 0}
+        if stream:
+            # running sums and counts of valid pixels
+            store["sum_arrs"] = {
+                wnam: np.zeros((yend - ystart, xend - xstart))
+                for wnam, (xstart, xend, ystart, yend) in wind_bounds.items()
+            }
+            store["count_arrs"] = {
+                wnam: np.zeros(sum_arr.shape, dtype=np.int32)
+                for wnam, sum_arr in store["sum_arrs"].items()
+            }
+        else:
+            # the frames are stacked along the last axis, see _combine.
+            # Any slots left unused stay NaN and are ignored.
+            store["arr3ds"] = {
+                wnam: np.full(
+                    (yend - ystart, xend - xstart, _gpars["nstack"]),
+                    np.nan,
+                    dtype=np.float32,
+                )
+                for wnam, (xstart, xend, ystart, yend) in wind_bounds.items()
+            }
+        _gstore[cnam] = store
+
+    store = _gstore[cnam]
+    store["nframes"] += 1
+
+    # Size of (binned) full frame
+    nyout = ccd.nytot // ccd.head.ybin
+    nxout = ccd.nxtot // ccd.head.xbin
+
+    # This frame's contribution to each output window, NaN where
+    # there is none. reproject returns float64; single precision is
+    # plenty and halves the memory traffic when combining. Unless
+    # streaming, these are the frame's slots in the stacks, so the data
+    # go straight into place.
+    if stream:
+        layers = {
+            wnam: np.full((yend - ystart, xend - xstart), np.nan, dtype=np.float32)
+            for wnam, (xstart, xend, ystart, yend) in wind_bounds.items()
+        }
+    else:
+        layers = {
+            wnam: arr3d[..., store["nframes"] - 1]
+            for wnam, arr3d in store["arr3ds"].items()
+        }
+
+    # integer part of the offset in binned pixels, to match the window
+    # bounds, rounded down so that negative offsets are treated in the
+    # same way as positive ones
+    iox = math.floor(frame_offset_x / ccd.head.xbin)
+    ioy = math.floor(frame_offset_y / ccd.head.ybin)
+
+    # no need to reproject at all if there is no shift (as for the frame
+    # the others are lined up on), since each box is then its window
+    unshifted = (
+        _gpars["copy_unshifted"] and frame_offset_x == 0 and frame_offset_y == 0
+    )
+
+    # Go through each window in the CCD
+    for wnam, wind in ccd.items():
+        # Only the area of the window shifted by the integer part of the
+        # offset is kept, so there's no bleedover into other windows when
+        # using 'nearest' interpolation for adaptive. Reproject onto just
+        # this box of the full frame.
+        xstart, xend, ystart, yend = wind_bounds[wnam]
+        x0 = min(max(xstart - iox, 0), nxout)
+        x1 = min(max(xend - iox, 0), nxout)
+        y0 = min(max(ystart - ioy, 0), nyout)
+        y1 = min(max(yend - ioy, 0), nyout)
+        if x0 == x1 or y0 == y1:
+            # shifted off the frame altogether
+            continue
+
+        if unshifted:
+            reprojected_data = wind.data
+        else:
+            # Set WCSs for the window and the box
+            pixel_wcs.wcs.crpix = (
+                crval1 + frame_offset_x / wind.xbin - xstart,
+                crval2 + frame_offset_y / wind.ybin - ystart,
+            )
+            pixel_wcs.wcs.set()
+            box_wcs.wcs.crpix = (crval1 - x0, crval2 - y0)
+            box_wcs.wcs.set()
+
+            # Carry out the re-projection
+            if (y1 - y0) * (x1 - x0) > BLOCK * BLOCK:
+                kwargs = _gpars["big_kwargs"]
+            else:
+                kwargs = _gpars["kwargs"]
+            reprojected_data, _ = _gpars["reproject"](
+                (wind.data, pixel_wcs),
+                box_wcs,
+                (y1 - y0, x1 - x0),
+                **kwargs,
+            )
+
+        # Paste into the output windows the box overlaps
+        for onam, (oxstart, oxend, oystart, oyend) in wind_bounds.items():
+            px0, px1 = max(x0, oxstart), min(x1, oxend)
+            py0, py1 = max(y0, oystart), min(y1, oyend)
+            if px0 < px1 and py0 < py1:
+                layers[onam][
+                    py0 - oystart : py1 - oystart,
+                    px0 - oxstart : px1 - oxstart,
+                ] = reprojected_data[py0 - y0 : py1 - y0, px0 - x0 : px1 - x0]
+
+    if stream:
+        # Add into the running sum and count of valid pixels
+        for wnam, layer in layers.items():
+            valid = ~np.isnan(layer)
+            sum_arr = store["sum_arrs"][wnam]
+            np.add(sum_arr, layer, out=sum_arr, where=valid)
+            store["count_arrs"][wnam] += valid
+
+
+def _combine_ccd(cnam):
+    """
+    Combines the frames accumulated by _add_frame for CCD `cnam`, freeing
+    them as it goes.
+
+    Returns: (stacks, nans, nframes) where `stacks` is a dictionary of
+    the combined data of each window, `nans` the set of windows left with
+    NaNs, and `nframes` the number of frames used, None, None and 0 if
+    there were none.
+    """
+    if cnam not in _gstore:
+        return None, None, 0
+
+    store = _gstore.pop(cnam)
+    stacks = {}
+    nans = set()
+    for wnam in _gpars["wind_bounds"][cnam]:
+        if _gpars["stream"]:
+            # pixels never covered end up as NaN
+            count_arr = store["count_arrs"][wnam]
+            with np.errstate(invalid="ignore"):
+                stacks[wnam] = (store["sum_arrs"][wnam] / count_arr).astype(
+                    np.float32
+                )
+            if (count_arr == 0).any():
+                nans.add(wnam)
+        else:
+            # Combine in blocks of rows to limit the memory needed for
+            # temporaries and keep the working set small. The combination
+            # is pixel by pixel, so the result is the same as combining
+            # everything in one go.
+            arr3d = store["arr3ds"].pop(wnam)
+            stack = np.empty(arr3d.shape[:2], dtype=np.float32)
+            for y0 in range(0, stack.shape[0], TILE):
+                stack[y0 : y0 + TILE] = _combine(
+                    arr3d[y0 : y0 + TILE],
+                    _gpars["method"],
+                    _gpars["sigma"],
+                    _gpars["maxiters"],
+                )
+            stacks[wnam] = stack
+            if anynan(stack):
+                nans.add(wnam)
+
+    return stacks, nans, store["nframes"]
+
+
 def shiftadd(args=None):
     """
     ``shiftadd [source]  (run first last twait tmax | flist) rfilen refccd
     fthresh reprmethod [(reprorder | consflux reprkernel kwidth regwidth)]
-    trim ([ncol nrow]) method [(sigma maxiters)] [overwrite] output``
+    trim ([ncol nrow]) method [(sigma maxiters)] [ncpu overwrite] output``
 
     Averages images from a run using mean combination, but shifting each
     image based on the positions of stars.
@@ -185,6 +624,13 @@ def shiftadd(args=None):
             The default is 'adaptive'.
             See https://reproject.readthedocs.io for details.
 
+            If the environment variable HIPERCAM_REPROJECT_BACKEND is set
+            to 'gpu' and the dfreproject module is installed, 'interp'
+            with reprorder 0 or 1 is carried out by dfreproject, on a GPU
+            if one is available, giving the same results as reproject
+            except within a pixel of the edges of windows. Other methods
+            and orders always run on the CPU.
+
         reprorder : int [if reprmethod is 'interp'; hidden]
             Order of interpolation to use. 0 is nearest neighbour, 1 is
             bilinear, 2 is quadratic, 3 is cubic. 1 is the default.
@@ -241,6 +687,12 @@ def shiftadd(args=None):
         maxiters : int [hidden; if method == 'c']
             Maximum number of iterations in sigma clipping. 3 is typical.
 
+        ncpu : int [hidden]
+           number of CPUs to use. The CCDs are stacked in parallel, one
+           process per CCD; any CPUs left over are used to multi-thread
+           the reprojection of windows of more than 256x256 (binned)
+           pixels. 1 to run serially.
+
         overwrite : bool [hidden]
            overwrite any pre-existing output files
 
@@ -281,6 +733,7 @@ def shiftadd(args=None):
         cl.register("method", Cline.LOCAL, Cline.HIDE)
         cl.register("sigma", Cline.LOCAL, Cline.HIDE)
         cl.register("maxiters", Cline.LOCAL, Cline.HIDE)
+        cl.register("ncpu", Cline.LOCAL, Cline.HIDE)
         cl.register("overwrite", Cline.LOCAL, Cline.HIDE)
         cl.register("output", Cline.LOCAL, Cline.PROMPT)
 
@@ -378,6 +831,10 @@ def shiftadd(args=None):
             maxiters = cl.get_value(
                 "maxiters", "maximum number of clipping iterations", 3
             )
+        else:
+            sigma, maxiters = 0.0, 0
+
+        ncpu = cl.get_value("ncpu", "number of CPUs to use", os.cpu_count() or 1, 1)
 
         overwrite = cl.get_value(
             "overwrite", "overwrite any pre-existing files on output", False
@@ -393,6 +850,56 @@ def shiftadd(args=None):
         )
 
     # inputs done with.
+
+    # reprojection backend
+    backend = os.environ.get("HIPERCAM_REPROJECT_BACKEND", "cpu").lower()
+    if backend not in ("cpu", "gpu"):
+        raise hcam.HipercamError(
+            f"HIPERCAM_REPROJECT_BACKEND = {backend} not recognised;"
+            " should be 'cpu' or 'gpu'"
+        )
+    if backend == "gpu":
+        if importlib.util.find_spec("dfreproject") is None:
+            raise hcam.HipercamError(
+                "HIPERCAM_REPROJECT_BACKEND = gpu but the dfreproject module"
+                " is not available"
+            )
+        if reprmethod != "interp" or reprorder not in GPU_ORDERS:
+            print(
+                "the gpu backend only supports reprmethod=interp with"
+                " reprorder = 0 or 1; will reproject on the CPU"
+            )
+            backend = "cpu"
+
+    # keyword arguments for the reprojection. The input and output WCS
+    # only differ by a shift, so the (costly) check that coordinates
+    # round-trip can be skipped.
+    if backend == "gpu":
+        repr_kwargs = {"order": reprorder}
+    elif reprmethod == "interp":
+        repr_kwargs = {"order": reprorder, "roundtrip_coords": False}
+    elif reprmethod == "exact":
+        repr_kwargs = {}
+    # OK - we are using adaptive then
+    # note we force boundary_mode to 'nearest'
+    # to avoid NaNs around the edge of the output
+    elif reprkernel == "Hann":
+        repr_kwargs = {
+            "conserve_flux": consflux,
+            "kernel": "Hann",
+            "boundary_mode": "nearest",
+            "roundtrip_coords": False,
+        }
+    else:
+        repr_kwargs = {
+            "conserve_flux": consflux,
+            "kernel_width": kwidth,
+            "sample_region_width": regwidth,
+            "kernel": "Gaussian",
+            "boundary_mode": "nearest",
+            "roundtrip_coords": False,
+        }
+
     rfile = hcam.reduction.Rfile.read(rfilen)
     if server_or_local:
         print("\nCalling 'grab' ...")
@@ -430,10 +937,22 @@ def shiftadd(args=None):
     with CleanUp(resource, server_or_local):
         # First we want to calculate how offset each frame is relative to the apertures
         print(f"calculating pixel shifts using CCD {ref_cnam}")
-        offsets = []
+        shifts = []
         fwhm_values = []
         mjds = []
-        xoff, yoff = 0.0, 0.0
+        findex = {}
+
+        # the reference apertures used to measure the shifts
+        ref_apnames = [
+            apnam for apnam, aper in rfile.aper[ref_cnam].items() if aper.ref
+        ]
+        if not ref_apnames:
+            raise hcam.HipercamError(
+                f"there are no reference apertures for CCD {ref_cnam}, "
+                f"so the shifts cannot be measured"
+            )
+
+        ccdwin = None
         with hcam.spooler.HcamListSpool(resource) as spool:
             # Note we don't just open the ref_ccd, we need the full mccd for `initial_checks`
             for nf, mccd in enumerate(spool):
@@ -452,15 +971,11 @@ def shiftadd(args=None):
                         f"so cannot be used as refccd"
                     )
 
-                # Find which window contains each aperture
-                ccdwin = {}
-                for apnam, aper in rfile.aper[ref_cnam].items():
-                    for wnam, wind in ccd.items():
-                        if wind.distance(aper.x, aper.y) > 0:
-                            ccdwin[apnam] = wnam
-                            break
-                        else:
-                            ccdwin[apnam] = None
+                if ccdwin is None:
+                    # first time through, work out which window contains
+                    # each aperture. As in 'reduce', we assume this is fixed
+                    # for the whole run.
+                    ccdwin = _aper_windows(rfile.aper[ref_cnam], ccd)
 
                 # Reposition the apertures on the reference CCD
                 store = {"mfwhm": -1.0, "mbeta": -1.0}
@@ -476,37 +991,26 @@ def shiftadd(args=None):
                     store,
                 )
 
-                # Store the mean FWHM, as well as the image date
+                # Store the mean FWHM, as well as the image date, and
+                # where to find them given the frame
+                findex[nf] = len(fwhm_values)
                 fwhm_values.append(store["mfwhm"])
                 mjds.append(mccd.head["MJDUTC"])
 
-                # Find the mean shifts (only using reference stars)
-                dx = np.mean(
-                    [
-                        store[apnam]["dx"]
-                        for apnam in rfile.aper[ref_cnam]
-                        if rfile.aper[ref_cnam][apnam].ref
-                    ]
-                )
-                dy = np.mean(
-                    [
-                        store[apnam]["dy"]
-                        for apnam in rfile.aper[ref_cnam]
-                        if rfile.aper[ref_cnam][apnam].ref
-                    ]
+                # Store the shifts of the reference stars relative to
+                # the previous frame
+                shifts.append(
+                    [(store[apnam]["dx"], store[apnam]["dy"]) for apnam in ref_apnames]
                 )
 
-                # Store the offsets relative to the previous frame
-                xoff += dx
-                yoff += dy
-                offsets.append((xoff, yoff))
-
-        # Offsets are now defined w.r.t to the positions in the
-        # aperture file for first image, and then w.r.t to
-        # previous file for subsequent images. For each CCD,
-        # we should center the offsets on 0,0. This minimises the
-        # risks of having unsampled pixels in the full frame data.
-        offsets = np.array(offsets)
+        # The mean shifts of the reference stars are defined w.r.t to the
+        # positions in the aperture file for first image, and then w.r.t
+        # to previous file for subsequent images, so they accumulate into
+        # the offsets. These are purely pixel shifts, so this is done for
+        # all frames at once. For each CCD, we should center the offsets
+        # on 0,0. This minimises the risks of having unsampled pixels in
+        # the full frame data.
+        offsets = np.cumsum(np.mean(shifts, axis=1), axis=0)
         offsets -= offsets.mean(axis=0)
 
         # Now find the CCD with the smallest offset from
@@ -531,170 +1035,157 @@ def shiftadd(args=None):
             # start with basic WCS, CRDELT1, no offsets
             orig_wcs = wcs.WCS(naxis=2)
 
-        # Now process each file CCD by CCD to reduce the memory footprint
-        header_string = "nframes="
-        for cnam in output_mccd:
-            print(f"stacking CCD {cnam}")
-            arrs = []
-            nframes_used = 0
-            with hcam.spooler.HcamListSpool(resource, cnam) as spool:
-                # Here we only open the CCD we're interested in
-                for nf, ccd in enumerate(spool):
-                    if not ccd.is_data():
+        # Now go through the files once more, reprojecting each CCD. The
+        # CCDs are independent, so they are farmed out to separate
+        # processes if more than one CPU is available, each process
+        # accumulating the frames of its own CCDs. The WCS is passed as a
+        # header string since WCS objects do not pickle reliably.
+        wcs_header = orig_wcs.to_header().tostring()
+        nproc = min(ncpu, len(output_mccd))
+
+        # any CPUs left over are used to multi-thread large reprojections
+        nthreads = ncpu // nproc
+
+        # binned pixel limits of each window, the same for every frame
+        wind_bounds = {}
+        for cnam, ccd in output_mccd.items():
+            wind_bounds[cnam] = {}
+            for wnam, wind in ccd.items():
+                xstart = wind.llx // wind.xbin
+                ystart = wind.lly // wind.ybin
+                wind_bounds[cnam][wnam] = (
+                    xstart,
+                    xstart + wind.nx,
+                    ystart,
+                    ystart + wind.ny,
+                )
+
+        # the number of frames that pass the FWHM threshold
+        nstack = sum(not (fthresh > 0 and fwhm > fthresh) for fwhm in fwhm_values)
+
+        initargs = (
+            wcs_header,
+            wind_bounds,
+            nstack,
+            reprmethod,
+            backend,
+            nthreads,
+            repr_kwargs,
+            method,
+            sigma,
+            maxiters,
+        )
+        if nproc > 1:
+            # one single-process executor per worker so that each CCD
+            # always goes to the same process
+            workers = [
+                ProcessPoolExecutor(
+                    max_workers=1, initializer=_init_stack, initargs=initargs
+                )
+                for n in range(nproc)
+            ]
+            ccd_worker = {
+                cnam: workers[n % nproc] for n, cnam in enumerate(output_mccd)
+            }
+        else:
+            workers = []
+            _init_stack(*initargs)
+
+        try:
+            pending = []
+            with hcam.spooler.HcamListSpool(resource) as spool:
+                for nf, mccd in enumerate(spool):
+                    if nf not in findex:
+                        # no data in this frame
                         continue
 
                     # Skip if FWHM is above threshold
-                    if fthresh > 0 and fwhm_values[nf] > fthresh:
+                    fwhm = fwhm_values[findex[nf]]
+                    if fthresh > 0 and fwhm > fthresh:
                         print(
                             f"skipping frame {nf + first}",
-                            f"(FWHM too large ({fwhm_values[nf]:.1f} > {fthresh:.1f}))",
+                            f"(FWHM too large ({fwhm:.1f} > {fthresh:.1f}))",
                         )
                         continue
 
                     print("resampling frame", nf + first)
-                    nframes_used += 1
 
                     # Find calculated offset
-                    frame_offset_x, frame_offset_y = offsets[nf]
-
-                    # Find output shape to resample each window onto (binned)
-                    # full frame array
-                    output_shape = (
-                        ccd.nytot // ccd.head.ybin,
-                        ccd.nxtot // ccd.head.xbin,
-                    )
-
-                    # Go through each window in the CCD
-                    for wnam, wind in ccd.items():
-                        # Make WCS to reproject data onto full frame
-                        # (binned) array
-                        pixel_wcs = copy.deepcopy(orig_wcs)
-                        crval1, crval2 = pixel_wcs.wcs.crpix
-                        window_offset_x = wind.llx // wind.xbin
-                        window_offset_y = wind.lly // wind.ybin
-                        pixel_wcs.wcs.crpix = (
-                            crval1 + frame_offset_x / wind.xbin - window_offset_x,
-                            crval2 + frame_offset_y / wind.ybin - window_offset_y,
-                        )
-
-                        # Carry out the re-projection
-                        if reprmethod == "interp":
-                            reprojected_data, _ = reproject_interp(
-                                (wind.data, pixel_wcs),
-                                orig_wcs,
-                                output_shape,
-                                order=reprorder,
-                            )
-                        elif reprmethod == "exact":
-                            reprojected_data, _ = reproject_exact(
-                                (wind.data, pixel_wcs),
-                                orig_wcs,
-                                output_shape,
-                            )
-                        # OK - we are using adaptive then
-                        # note we force boundary_mode to 'nearest'
-                        # to avoid NaNs around the edge of the output
-                        elif reprkernel == "Hann":
-                            reprojected_data, _ = reproject_adaptive(
-                                (wind.data, pixel_wcs),
-                                orig_wcs,
-                                output_shape,
-                                conserve_flux=consflux,
-                                kernel="Hann",
-                                boundary_mode="nearest",
+                    frame_offset_x, frame_offset_y = offsets[findex[nf]]
+
+                    # Hand each CCD to its process. Only the previous frame
+                    # is waited for, so that the next file is read while
+                    # this one is processed, without frames piling up in
+                    # memory.
+                    futures = []
+                    for cnam, ccd in mccd.items():
+                        if not ccd.is_data():
+                            continue
+                        if workers:
+                            futures.append(
+                                ccd_worker[cnam].submit(
+                                    _add_frame,
+                                    cnam,
+                                    ccd,
+                                    frame_offset_x,
+                                    frame_offset_y,
+                                )
                             )
                         else:
-                            reprojected_data, _ = reproject_adaptive(
-                                (wind.data, pixel_wcs),
-                                orig_wcs,
-                                output_shape,
-                                conserve_flux=consflux,
-                                kernel_width=kwidth,
-                                sample_region_width=regwidth,
-                                kernel="Gaussian",
-                                boundary_mode="nearest",
-                            )
+                            _add_frame(cnam, ccd, frame_offset_x, frame_offset_y)
+                    for future in pending:
+                        future.result()
+                    pending = futures
+
+            for future in pending:
+                future.result()
+
+            # Average over the stack of images
+            results = {}
+            if workers:
+                futures = {
+                    cnam: ccd_worker[cnam].submit(_combine_ccd, cnam)
+                    for cnam in output_mccd
+                }
+                for cnam, future in futures.items():
+                    results[cnam] = future.result()
+            else:
+                for cnam in output_mccd:
+                    results[cnam] = _combine_ccd(cnam)
+        finally:
+            for worker in workers:
+                worker.shutdown()
 
-                        # We need to mask the area outside of the offset window with NaNs,
-                        # so there's no bleedover into other windows when stacking
-                        # when using 'nearest' interpolation for adaptive
-                        mask = np.zeros_like(reprojected_data, dtype=bool)
-                        xstart = wind.llx // wind.xbin
-                        xend = xstart + wind.nx
-                        ystart = wind.lly // wind.ybin
-                        yend = ystart + wind.ny
-                        mask[
-                            ystart - int(frame_offset_y) : yend - int(frame_offset_y),
-                            xstart - int(frame_offset_x) : xend - int(frame_offset_x),
-                        ] = True
-                        reprojected_data[~mask] = np.nan
-
-                        # Save the FF reprojected data
-                        arrs.append(reprojected_data)
-
-            # Average over the stack of FF images
-            print(f"combining {nframes_used} frames for CCD {cnam}")
+        header_string = "nframes="
+        for cnam in output_mccd:
+            stacks, nans, nframes_used = results[cnam]
+            print(f"combined {nframes_used} frames for CCD {cnam}")
             header_string += f"CCD{cnam}({nframes_used:d}),"
 
-            if len(arrs) == 0 or nframes_used == 0:
+            if nframes_used == 0:
                 raise hcam.HipercamError(
                     f"found no data for CCD {cnam} in the selected frames"
                 )
 
-            arr3d = np.stack(arrs)
-
-            with warnings.catch_warnings():
-                # ignore warnings about all-nan slices
-                # (we set NaNs outside of the windows)
-                warnings.filterwarnings(
-                    "ignore",
-                    category=RuntimeWarning,
-                    message="All-NaN slice encountered",
-                )
-                if method == "m":
-                    stack = medianfunc(arr3d, axis=0)
-                elif method == "c" and sigma > 0:
-                    # clipped mean
-                    mask = sigma_clip(
-                        arr3d,
-                        sigma_lower=sigma,
-                        sigma_upper=sigma,
-                        axis=0,
-                        copy=False,
-                        maxiters=maxiters,
-                        cenfunc="mean",
-                        stdfunc="std",
-                        masked=True,
-                    )
-                    # fill mask with nans
-                    arr3d[mask.mask] = np.nan
-                    stack = meanfunc(arr3d, axis=0)
-                else:
-                    # simple mean
-                    stack = meanfunc(arr3d, axis=0)
-
-            # Crop the FF images back into the individual windows
-            for wnam, wind in output_mccd[cnam].items():
-                xstart = wind.llx // wind.xbin
-                xend = xstart + wind.nx
-                ystart = wind.lly // wind.ybin
-                yend = ystart + wind.ny
-                crop = stack[ystart:yend, xstart:xend]
-
-                # check for NaNs in the cropped data
-                if np.isnan(crop).any():
+            for wnam in output_mccd[cnam]:
+                # check for NaNs in the combined data
+                if wnam in nans:
                     # The pipeline can't really handle NaNs, so we raise an error
                     raise hcam.HipercamError(
                         f"NaN values detected in combined data for CCD {cnam}, window {wnam}"
                     )
 
-                output_mccd[cnam][wnam].data = crop
+                # stacked in single precision, but written out in double
+                # as always
+                output_mccd[cnam][wnam].data = stacks[wnam].astype(np.float64)
 
         # Add history and other keywords to the header
         output_mccd.head.add_history("Result of shiftadd")
         reprmethod_string = reprmethod
         if reprmethod == "interp":
             reprmethod_string += f" ({reprorder})"
+            if backend == "gpu":
+                reprmethod_string += " [dfreproject]"
         elif reprmethod == "adaptive":
             if reprkernel == "Gaussian":
                 reprmethod_string += (